@@ -1,67 +1,339 @@
 """Main module with higher-level logic for email2pr."""
 
 import argparse
+import functools
+import logging
+import os
+import shutil
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.utils import parseaddr
 from typing import Any
+from typing import Callable
+from typing import Dict
 from typing import List
+from typing import TYPE_CHECKING
+from typing import Union
 
-from . import github
-from . import params
+from . import log
 from . import patch
 from . import poller
-from . import repo
+from . import profiling
+from . import scheduler
 from . import utils
 
+# Modules that import git, github, or yaml are imported only when needed,
+# which keeps startup fast when there is no new email (e.g. with --once)
+if TYPE_CHECKING:
+    from . import repo
+
+logger = logging.getLogger(__name__)
+
+
+class TargetResult():
+    """Result of processing an email for one repo and base branch."""
+
+    def __init__(
+        self,
+        info: 'repo.RepoInfo',
+        pr_url: Union[str, None] = None,
+        error: Union[Exception, None] = None,
+    ) -> None:
+        """
+        Constructor.
+
+        :param info: the information of the target
+        :param pr_url: the URL of the created PR, or `None` if it failed
+        :param error: the error, or `None` if it succeeded
+        """
+        self.info = info
+        self.pr_url = pr_url
+        self.error = error
+
+    @property
+    def target(self) -> str:
+        branch = self.info.branch if self.info.branch is not None else '(default)'
+        return f'{self.info.owner}/{self.info.name}:{branch}'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'target': self.target,
+            'pr_url': self.pr_url,
+            'error': str(self.error) if self.error is not None else None,
+        }
+
 
 class EmailToPr():
     """Main class with high-level API."""
 
     def __init__(self, args: Any) -> None:
         """Constructor."""
-        self._manager = repo.RepoManager(args)
+        self._params = args
+        self._manager = None
+        self._batcher = None
+        self._workers_lock = threading.Lock()
+        self._scheduler = scheduler.from_params(args)
+        self._profiler = profiling.from_params(args)
         email_info = poller.EmailConnectionInfo(args)
+        self._checkpoint = poller.Checkpoint(
+            utils.get_param(args, 'state_file', poller.DEFAULT_STATE_FILE))
         self._poller = poller.EmailPoller(
             email_info,
             self._email_callback,
             ('SUBJECT', 'PATCH'),
+            self._checkpoint,
+            int(utils.get_param(args, 'email_max_attempts', poller.DEFAULT_MAX_ATTEMPTS)),
         )
 
-    def _email_callback(self, raw_email_data: List[Any]) -> None:
-        """Execute logic, on new email."""
-        print(f'===new email!====')
-        try:
+    def _load_workers(self) -> None:
+        """Import modules and create objects needed to process emails, if not done yet."""
+        with self._workers_lock:
+            if self._manager is not None:
+                return
+            from . import github
+            from . import repo
+            self._batcher = github.from_params(self._params)
+            self._manager = repo.RepoManager(self._params)
+
+    def _email_callback(self, uid: int, raw_email_data: List[Any]) -> None:
+        """Schedule processing of new email."""
+        with log.job_context(log.new_job_id()) as job_id:
             msg = utils.email_from_raw_data(raw_email_data)
-            # Clone repo
-            # TODO maybe it already exists
-            repo, info = self._manager.clone_from_email(msg)
-            if repo is None or info is None:
-                raise utils.EmailToPrError('no repo URL key!')
-            # Create patch file in repo directory
-            patch_filename, title, body = patch.from_email(msg, info.path)
-            # Apply git patch to new branch
-            pr_branch, base_branch = self._manager.apply_patch(repo, patch_filename)
+            # Same forms as the keys of sched_weights: plain address and URL without '.git'
+            sender = parseaddr(msg['from'] or '')[1].lower()
+            repo_urls = utils.get_repo_urls(msg.get_payload())
+            repo_url = utils.strip_git_suffix(repo_urls[0].rstrip('/')) if repo_urls else ''
+            logger.info(
+                'new email',
+                extra={
+                    'uid': str(uid),
+                    'message_id': msg['message-id'],
+                    'subject': msg['subject'],
+                },
+            )
+            if self._profiler.should_profile(msg):
+                repo_name = repo_url.rsplit('/', 1)[-1]
+                func = functools.partial(
+                    self._process_email_profiled, job_id, msg, str(uid), repo_name)
+            else:
+                func = functools.partial(self._process_email, job_id, msg)
+            func = functools.partial(self._run_job, uid, func)
+            # Jobs sharing a repo clone can't run at the same time
+            resources = [utils.add_git_suffix(url) for url in repo_urls] or None
+            self._scheduler.submit(scheduler.Job(sender, repo_url, func, resources))
+
+    def _run_job(self, uid: int, func: Callable[[], bool]) -> None:
+        """Run job, then let the poller know that its email was processed."""
+        success = False
+        try:
+            success = func()
+        finally:
+            self._poller.done(uid, success)
+
+    def _process_email_profiled(
+        self,
+        job_id: str,
+        msg: EmailMessage,
+        uid: str,
+        repo_name: str,
+    ) -> bool:
+        """Execute logic for an email under the profiler."""
+        with log.job_context(job_id), self._profiler.profile(uid, repo_name, job_id):
+            return self._process_email(job_id, msg)
+
+    def _process_email(self, job_id: str, msg: EmailMessage) -> bool:
+        """
+        Execute logic for an email.
+
+        :return: `True` if it succeeded for all targets, `False` otherwise
+        """
+        with log.job_context(job_id):
+            try:
+                with log.stage('total', logger):
+                    self._process_email_stages(msg)
+            except utils.EmailToPrError as e:
+                logger.error(f'email2pr error: {e}')
+                return False
+        return True
+
+    def _process_email_stages(self, msg: EmailMessage) -> None:
+        """Execute each stage of the logic for an email, for all of its targets."""
+        self._load_workers()
+        targets = self._manager.targets_from_email(msg)
+        if not targets:
+            raise utils.EmailToPrError('no repo URL key!')
+        job_id = log.get_job_id()
+        # Create patch file once, shared by all targets
+        patch_dir = os.path.join(self._manager.repo_dir, 'patches', job_id or log.new_job_id())
+        os.makedirs(patch_dir, exist_ok=True)
+        try:
+            with log.stage('patch', logger):
+                patch_filename, title, body = patch.from_email(msg, patch_dir)
+            patch_path = os.path.join(patch_dir, patch_filename)
+            # Same or revised patch sent again gives the same branch, so its PR is reused
+            branch_key = patch.get_branch_key(title, parseaddr(msg['from'] or '')[1])
+            labels = utils.get_labels(msg.get_payload())
+            reviewers = utils.get_reviewers(msg.get_payload())
+            profiles = profiling.get_profiles()
+
+            def in_job(func: Callable[..., Any]) -> Callable[..., Any]:
+                def wrapper(*args: Any) -> Any:
+                    with log.job_context(job_id), profiling.profile_thread(profiles):
+                        return func(*args)
+                return wrapper
+
+            repos = {}
+            fetch_errors = {}
+
+            def fetch(info: 'repo.RepoInfo') -> None:
+                # Only fail the targets of this repo
+                try:
+                    repos[info.url] = self._manager.fetch(info)
+                except Exception as e:
+                    fetch_errors[info.url] = e
+
+            def process_target(info: 'repo.RepoInfo') -> TargetResult:
+                result = TargetResult(info)
+                if info.url in fetch_errors:
+                    result.error = fetch_errors[info.url]
+                    return result
+                # Let the batcher know that a PR may be coming
+                if self._batcher is not None:
+                    self._batcher.register()
+                try:
+                    result.pr_url = self._process_target(
+                        repos[info.url], info, patch_path, branch_key,
+                        title, body, labels, reviewers)
+                except Exception as e:
+                    result.error = e
+                finally:
+                    if self._batcher is not None:
+                        self._batcher.unregister()
+                return result
+
+            workers = utils.get_param(self._params, 'target_workers', 4)
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                # Clone or fetch each repo only once, even if it has multiple targets
+                unique = list({info.url: info for info in targets}.values())
+                with log.stage('clone', logger):
+                    list(executor.map(in_job(fetch), unique))
+                # The same target can be given in different forms (e.g. with or without the
+                # '.git' suffix, or as the default branch), but targets must not share a branch
+                unique_targets = {}
+                for info in targets:
+                    if info.url in repos and info.branch is None:
+                        try:
+                            info.branch = self._manager.get_default_branch(repos[info.url])
+                        except Exception as e:
+                            logger.warning(f'failed to get default branch: {e}')
+                    unique_targets.setdefault((info.url, info.branch), info)
+                targets = list(unique_targets.values())
+                results = list(executor.map(in_job(process_target), targets))
+        finally:
+            shutil.rmtree(patch_dir, ignore_errors=True)
+        self._report(results)
+
+    def _process_target(
+        self,
+        main_repo: Any,
+        info: 'repo.RepoInfo',
+        patch_path: str,
+        branch_key: str,
+        title: str,
+        body: str,
+        labels: List[str],
+        reviewers: List[str],
+    ) -> str:
+        """
+        Apply patch to a target, push it, and create a PR.
+
+        :return: the PR URL
+        """
+        # Apply git patch to new branch
+        with log.stage('apply', logger):
+            worktree, pr_branch, base_branch = self._manager.apply_patch(
+                main_repo, info, patch_path, branch_key)
+        try:
             # Push to remote
-            self._manager.push(repo)
-            # Create PR
+            with log.stage('push', logger):
+                self._manager.push(worktree, base_branch)
+        finally:
+            self._manager.remove_worktree(main_repo, worktree)
+        # Create PR
+        from . import github
+        with log.stage('pr', logger):
             pr_info = github.PrInfo(
-                self._manager.repo_user,
+                info.owner,
                 info.name,
                 base_branch,
                 pr_branch,
                 title,
-                body)
-            url = github.create_pr(self._manager.repo_token, pr_info)
-            print(f'PR created: {url}')
-        except utils.EmailToPrError as e:
-            print(f'email2pr error: {e}')
+                body,
+                labels=labels,
+                reviewers=reviewers)
+            if self._batcher is not None:
+                return self._batcher.create_pr(pr_info)
+            return github.create_pr(self._params.repo_token, pr_info)
+
+    def _report(self, results: List['TargetResult']) -> None:
+        """Log results of all targets of an email."""
+        for result in results:
+            if result.error is None:
+                logger.info(f'PR created: {result.pr_url}', extra=result.to_dict())
+            else:
+                logger.error(
+                    f"failed for '{result.target}': {result.error}", extra=result.to_dict())
+        failed = [r for r in results if r.error is not None]
+        logger.info(
+            f'{len(results) - len(failed)}/{len(results)} targets succeeded',
+            extra={'targets': [r.to_dict() for r in results]},
+        )
+        if failed:
+            raise utils.EmailToPrError(f'{len(failed)} target(s) failed')
 
     def launch(self) -> None:
         """Launch polling of email server."""
-        self._poller.poll()
+        try:
+            with self._checkpoint.lock():
+                if utils.get_param(self._params, 'profile_poll', False):
+                    path = os.path.join(
+                        utils.get_param(self._params, 'profile_dir', profiling.DEFAULT_DIR),
+                        f'poll-{time.strftime("%Y%m%d%H%M%S")}.collapsed')
+                    with profiling.SamplingProfiler(path, threading.get_ident()):
+                        self._poller.poll()
+                else:
+                    self._poller.poll()
+        finally:
+            self._scheduler.shutdown()
+            self._scheduler.report()
+            log.shutdown()
+
+    def run_once(self) -> int:
+        """
+        Process new emails since the last checkpoint, wait until they are done, then return.
+
+        :return: the number of processed emails
+        :raise EmailToPrError: if another process is using the same checkpoint
+        """
+        with self._checkpoint.lock():
+            count = 0
+            try:
+                count = self._poller.poll_once()
+            finally:
+                # The checkpoint moves as emails are processed, so wait with the lock held
+                self._scheduler.shutdown()
+                if count > 0:
+                    self._scheduler.report()
+        return count
 
 
 def get_parser() -> argparse.ArgumentParser:
     """Parse all email2pr args."""
+    from . import github
+    from . import repo
     parser = argparse.ArgumentParser(
         description='Create GitHub PRs from patch emails.',
         epilog=(
@@ -71,21 +343,35 @@ def get_parser() -> argparse.ArgumentParser:
         parents=[
             poller.get_parser(),
             repo.get_parser(),
+            scheduler.get_parser(),
+            github.get_parser(),
+            log.get_parser(),
+            profiling.get_parser(),
         ]
     )
+    parser.add_argument(
+        '--once',
+        help='process new emails since the last run, then exit (e.g. for cron)',
+        action='store_true')
     return parser
 
 
 def get_params(argv) -> Any:
     args = None
+    # '--once' can also be used with a parameters file
+    once = '--once' in argv[1:]
+    file_argv = [arg for arg in argv if arg != '--once']
     # If all arguments given, or if help wanted,
     # use argparse, else use parameters file
     is_help = len(argv) == 2 and argv[1] in ['-h', '--help']
-    if len(argv) > 2 or is_help:
-        args = get_parser().parse_args()
+    if len(file_argv) > 2 or is_help:
+        args = get_parser().parse_args(argv[1:])
     else:
-        params_file = argv[1] if len(argv) == 2 else None
+        from . import params
+        params_file = file_argv[1] if len(file_argv) == 2 else None
         args = params.Params(params_file)
+        if once:
+            args.params['once'] = True
         args.assert_params_defined([
             'email_user',
             'email_pass',
@@ -97,6 +383,27 @@ def get_params(argv) -> Any:
 
 def main(argv=sys.argv) -> None:
     """Do setup for email2pr."""
+    start = time.monotonic()
     args = get_params(argv)
+    log.from_params(args)
     etopr = EmailToPr(args)
-    etopr.launch()
+    logger.debug(
+        'startup done',
+        extra={'startup_ms': round((time.monotonic() - start) * 1000.0, 3)},
+    )
+    if args.once:
+        try:
+            count = etopr.run_once()
+            logger.info(
+                f'processed {count} new email(s)',
+                extra={
+                    'count': count,
+                    'elapsed_ms': round((time.monotonic() - start) * 1000.0, 3),
+                },
+            )
+        except utils.EmailToPrError as e:
+            logger.error(f'email2pr error: {e}')
+        finally:
+            log.shutdown()
+    else:
+        etopr.launch()
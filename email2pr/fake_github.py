@@ -0,0 +1,297 @@
+"""Module with a local stand-in for the GitHub GraphQL API, for testing."""
+
+import argparse
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from . import github
+
+_SELECTION_RE = re.compile(r'^(?:(\w+)\s*:\s*)?(\w+)\s*(?:\((.*)\))?$', re.DOTALL)
+_ARG_RE = re.compile(r'(\w+)\s*:\s*\$(\w+)')
+
+
+def _split_selections(query: str) -> List[Tuple[str, str]]:
+    """
+    Split GraphQL document into its top-level selections.
+
+    This only supports the subset of GraphQL used by the github module.
+
+    :param query: the GraphQL document
+    :return: the list of (selection header, selection body)
+    """
+    start = query.index('{')
+    selections = []
+    depth = 0
+    header = ''
+    body_start = None
+    for index in range(start + 1, len(query)):
+        c = query[index]
+        if c == '{':
+            if depth == 0:
+                body_start = index
+            depth += 1
+        elif c == '}':
+            if depth == 0:
+                break
+            depth -= 1
+            if depth == 0:
+                selections.append((header.strip(), query[body_start:(index + 1)]))
+                header = ''
+        elif depth == 0:
+            header += c
+    return selections
+
+
+class FakeGitHub():
+    """In-memory GitHub GraphQL endpoint."""
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.repos: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.users: Dict[str, str] = {}
+        self.pull_requests: Dict[str, Dict[str, Any]] = {}
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def add_repo(
+        self,
+        owner: str,
+        name: str,
+        labels: List[str] = None,
+    ) -> None:
+        """
+        Add a repo.
+
+        :param owner: the owner of the repo
+        :param name: the name of the repo
+        :param labels: the names of the labels defined in the repo
+        """
+        repo_id = f'R_{len(self.repos)}'
+        self.repos[(owner, name)] = {
+            'id': repo_id,
+            'owner': owner,
+            'name': name,
+            'labels': {label: f'{repo_id}_L_{i}' for i, label in enumerate(labels or [])},
+        }
+
+    def add_user(self, login: str) -> None:
+        """
+        Add a user.
+
+        :param login: the username
+        """
+        self.users[login] = f'U_{len(self.users)}'
+
+    def _repo_by_id(self, repo_id: str) -> Dict[str, Any]:
+        for repo in self.repos.values():
+            if repo['id'] == repo_id:
+                return repo
+        raise ValueError(f"Could not resolve to a node with the global id of '{repo_id}'")
+
+    def _repository(
+        self,
+        args: Dict[str, Any],
+        body: str,
+        variables: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        repo = self.repos.get((args['owner'], args['name']))
+        if repo is None:
+            raise ValueError(
+                f"Could not resolve to a Repository with the name "
+                f"'{args['owner']}/{args['name']}'.")
+        # Nested pullRequests(headRefName: $x, baseRefName: $y, states: OPEN) selection
+        pr_args = {
+            name: variables.get(var)
+            for name, var in _ARG_RE.findall(body)
+            if name in ('headRefName', 'baseRefName')
+        }
+        pull_requests = [
+            {'url': pr['url']}
+            for pr in self.pull_requests.values()
+            if pr['repositoryId'] == repo['id'] and pr['state'] == 'OPEN' and all(
+                pr[name] == value for name, value in pr_args.items())
+        ]
+        return {
+            'id': repo['id'],
+            'labels': {'nodes': [{'id': i, 'name': n} for n, i in repo['labels'].items()]},
+            'pullRequests': {'nodes': pull_requests[:1]},
+        }
+
+    def _user(
+        self,
+        args: Dict[str, Any],
+        body: str,
+        variables: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        if args['login'] not in self.users:
+            raise ValueError(f"Could not resolve to a User with the login of '{args['login']}'.")
+        return {'id': self.users[args['login']]}
+
+    def _create_pull_request(
+        self,
+        args: Dict[str, Any],
+        body: str,
+        variables: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        pr_input = args['input']
+        repo = self._repo_by_id(pr_input['repositoryId'])
+        for pr in self.pull_requests.values():
+            if (
+                pr['repositoryId'] == repo['id'] and
+                pr['headRefName'] == pr_input['headRefName'] and
+                pr['baseRefName'] == pr_input['baseRefName'] and
+                pr['state'] == 'OPEN'
+            ):
+                raise ValueError(
+                    f"A pull request already exists for {repo['owner']}:"
+                    f"{pr_input['headRefName']}.")
+        number = len(self.pull_requests) + 1
+        pr_id = f'PR_{number}'
+        url = f"https://github.com/{repo['owner']}/{repo['name']}/pull/{number}"
+        self.pull_requests[pr_id] = {
+            **pr_input,
+            'id': pr_id,
+            'url': url,
+            'state': 'OPEN',
+            'labelIds': [],
+            'reviewerIds': [],
+        }
+        return {'pullRequest': {'id': pr_id, 'url': url}}
+
+    def _add_labels(
+        self,
+        args: Dict[str, Any],
+        body: str,
+        variables: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        labels_input = args['input']
+        self.pull_requests[labels_input['labelableId']]['labelIds'] += labels_input['labelIds']
+        return {'clientMutationId': None}
+
+    def _request_reviews(
+        self,
+        args: Dict[str, Any],
+        body: str,
+        variables: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        reviews_input = args['input']
+        self.pull_requests[reviews_input['pullRequestId']]['reviewerIds'] += \
+            reviews_input['userIds']
+        return {'clientMutationId': None}
+
+    def __call__(self, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Execute GraphQL document.
+
+        This has the same signature as a github.Transport.
+
+        :param query: the GraphQL document
+        :param variables: the variables
+        :return: the JSON response
+        """
+        resolvers = {
+            'repository': self._repository,
+            'user': self._user,
+            'createPullRequest': self._create_pull_request,
+            'addLabelsToLabelable': self._add_labels,
+            'requestReviews': self._request_reviews,
+        }
+        data = {}
+        errors = []
+        with self._lock:
+            self.request_count += 1
+            for header, body in _split_selections(query):
+                match = _SELECTION_RE.match(header)
+                if match is None:
+                    return {'errors': [{'message': f"Parse error on '{header}'"}]}
+                alias, field, args_string = match.groups()
+                alias = alias if alias is not None else field
+                if field == 'rateLimit':
+                    data[alias] = {'cost': 1, 'remaining': 5000}
+                    continue
+                if field not in resolvers:
+                    return {'errors': [{'message': f"Field '{field}' doesn't exist"}]}
+                args = {
+                    name: variables.get(var)
+                    for name, var in _ARG_RE.findall(args_string or '')
+                }
+                try:
+                    data[alias] = resolvers[field](args, body, variables)
+                except (KeyError, ValueError) as e:
+                    data[alias] = None
+                    errors.append({'message': str(e), 'path': [alias]})
+        response = {'data': data}
+        if errors:
+            response['errors'] = errors
+        return response
+
+
+def serve(
+    fake: FakeGitHub,
+    port: int = 0,
+) -> HTTPServer:
+    """
+    Serve fake endpoint over HTTP on localhost, in a background thread.
+
+    :param fake: the fake endpoint
+    :param port: the port to use, or 0 to pick a free one
+    :return: the server
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            response = json.dumps(fake(request['query'], request.get('variables') or {}))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(response.encode('utf-8'))
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = HTTPServer(('localhost', port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main() -> None:
+    """Create a few PRs against the fake endpoint."""
+    parser = argparse.ArgumentParser(description='Exercise fake GitHub GraphQL endpoint.')
+    parser.add_argument(
+        '--count', '-n',
+        help='the number of PRs to create (default: %(default)s)',
+        type=int,
+        default=25)
+    args = parser.parse_args()
+
+    fake = FakeGitHub()
+    fake.add_repo('user', 'repo', ['bug'])
+    fake.add_user('reviewer')
+    server = serve(fake)
+    url = f'http://localhost:{server.server_address[1]}/graphql'
+    infos = [
+        github.PrInfo(
+            'user', 'repo', 'master', f'branch-{i}', f'PR {i}', '', labels=['bug'],
+            reviewers=['reviewer'])
+        for i in range(args.count)
+    ]
+    results = github.create_prs(
+        'token', infos, transport=github.http_transport('token', url), fallback=False)
+    for result in results:
+        print(result)
+    print(f'{len(infos)} PRs created with {fake.request_count} GraphQL requests')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,29 @@
 """Module for interfacing with GitHub."""
 
 import argparse
+import json
+import logging
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Union
 
-from github import Github
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+# Secondary rate limits count each mutation as 5 points
+MUTATION_COST = 5
+
+# (query, variables) -> full JSON response
+Transport = Callable[[str, Dict[str, Any]], Dict[str, Any]]
 
 
 class PrInfo():
@@ -17,6 +38,8 @@ class PrInfo():
         title: str,
         body: str,
         user_org_origin: str = None,
+        labels: List[str] = None,
+        reviewers: List[str] = None,
     ) -> None:
         """
         Constructor.
@@ -27,8 +50,10 @@ class PrInfo():
         :param branch_head: the name of the branch which we want to merge into the base branch
         :param title: the title of the pull request
         :param body: the body of the pull request
-        :param user_org_origin: the username or organisation name that contains the PR branch, or 
+        :param user_org_origin: the username or organisation name that contains the PR branch, or
             `None` if it's the same as user_org
+        :param labels: the names of the labels to add to the PR
+        :param reviewers: the usernames of the reviewers to request
         """
         self.user_org = user_org
         self.repo_name = repo_name
@@ -38,6 +63,8 @@ class PrInfo():
         self.title = title
         self.body = body
         self.user_org_origin = user_org_origin if user_org_origin is not None else user_org
+        self.labels = labels if labels is not None else []
+        self.reviewers = reviewers if reviewers is not None else []
 
     @property
     def full_pr_repo(self) -> str:
@@ -55,19 +82,417 @@ def create_pr(
     :param info: the pull request info
     :return: the pull request URL
     """
+    # Only imported when needed, since the GraphQL API is used first
+    from github import Github
     g = Github(token)
     repo = g.get_repo(info.full_pr_repo)
+    # Reuse PR if it already exists, e.g. when retrying
+    existing = repo.get_pulls(
+        state='open',
+        head=f'{info.user_org_origin}:{info.branch_head}',
+        base=info.branch_base,
+    )
+    for pr in existing:
+        logger.info(f'reusing existing PR: {pr.html_url}')
+        return pr.html_url
     pr = repo.create_pull(
         title=info.title,
         head=info.branch_head,
         base=info.branch_base,
         body=info.body,
     )
+    if info.labels:
+        pr.add_to_labels(*info.labels)
+    if info.reviewers:
+        pr.create_review_request(reviewers=info.reviewers)
     return pr.html_url
 
 
+def http_transport(
+    token: str,
+    url: str = GRAPHQL_URL,
+) -> Transport:
+    """
+    Get transport that sends GraphQL requests over HTTP.
+
+    :param token: the token to access the GitHub API
+    :param url: the GraphQL endpoint URL
+    :return: the transport
+    """
+    def transport(query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        request = urllib.request.Request(
+            url,
+            data=json.dumps({'query': query, 'variables': variables}).encode('utf-8'),
+            headers={
+                'Authorization': f'bearer {token}',
+                'Content-Type': 'application/json',
+            },
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except (urllib.error.URLError, ValueError) as e:
+            raise utils.EmailToPrError('GraphQL request failed', e)
+    return transport
+
+
+def _execute(
+    transport: Transport,
+    query: str,
+    variables: Dict[str, Any],
+) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Execute GraphQL document.
+
+    :param transport: the transport to use
+    :param query: the GraphQL document
+    :param variables: the variables
+    :return: (the data, the error messages by top-level alias)
+    """
+    response = transport(query, variables)
+    data = response.get('data') or {}
+    errors = {}
+    for error in response.get('errors') or []:
+        path = error.get('path') or []
+        if not path:
+            # Error for the whole document, e.g. syntax or rate limit
+            raise utils.EmailToPrError(f"GraphQL error: {error.get('message')}")
+        errors[path[0]] = error.get('message', '')
+    return data, errors
+
+
+def _document(
+    operation: str,
+    declarations: List[str],
+    selections: List[str],
+) -> str:
+    """Build GraphQL document from variable declarations and top-level selections."""
+    header = f"{operation}({', '.join(declarations)})" if declarations else operation
+    return header + ' {\n' + '\n'.join(f'  {s}' for s in selections) + '\n}'
+
+
+def _create_prs_graphql(
+    transport: Transport,
+    infos: List[PrInfo],
+) -> List[Union[str, Exception]]:
+    """
+    Create pull requests using batched GraphQL requests.
+
+    Three requests are made regardless of the number of PRs: one to look up repo, label and
+    user IDs and existing PRs, one to create the PRs, and one to add labels and request
+    reviews (if needed). Existing open PRs with the same head and base branches are reused.
+
+    :param transport: the transport to use
+    :param infos: the pull requests info
+    :return: the PR URL or the error, for each PR
+    """
+    results: List[Union[str, Exception]] = [None] * len(infos)
+
+    # Look up IDs
+    declarations = []
+    selections = ['rateLimit { cost remaining }']
+    variables = {}
+    logins = sorted({login for info in infos for login in info.reviewers})
+    for i, info in enumerate(infos):
+        declarations += [
+            f'$owner{i}: String!',
+            f'$name{i}: String!',
+            f'$head{i}: String!',
+            f'$base{i}: String!',
+        ]
+        selections.append(
+            f'r{i}: repository(owner: $owner{i}, name: $name{i}) '
+            '{ id labels(first: 100) { nodes { id name } } '
+            f'pullRequests(headRefName: $head{i}, baseRefName: $base{i}, states: OPEN, '
+            'first: 1) { nodes { url } } }'
+        )
+        variables[f'owner{i}'] = info.user_org
+        variables[f'name{i}'] = info.repo_name
+        variables[f'head{i}'] = info.branch_head
+        variables[f'base{i}'] = info.branch_base
+    for j, login in enumerate(logins):
+        declarations.append(f'$login{j}: String!')
+        selections.append(f'u{j}: user(login: $login{j}) {{ id }}')
+        variables[f'login{j}'] = login
+    data, errors = _execute(transport, _document('query', declarations, selections), variables)
+    rate_limit = data.get('rateLimit') or {}
+    if rate_limit.get('remaining', MUTATION_COST * len(infos)) < MUTATION_COST * len(infos):
+        raise utils.EmailToPrError('not enough GraphQL rate limit points left')
+    user_ids = {
+        login: data[f'u{j}']['id'] for j, login in enumerate(logins) if data.get(f'u{j}')
+    }
+
+    # Create PRs
+    declarations = []
+    selections = []
+    variables = {}
+    label_ids = {}
+    for i, info in enumerate(infos):
+        repository = data.get(f'r{i}')
+        if repository is None:
+            results[i] = utils.EmailToPrError(
+                f"failed to find repo '{info.full_pr_repo}': {errors.get(f'r{i}', '')}")
+            continue
+        existing = repository['pullRequests']['nodes']
+        if existing:
+            logger.info(f"reusing existing PR: {existing[0]['url']}")
+            results[i] = existing[0]['url']
+            continue
+        labels = {node['name']: node['id'] for node in repository['labels']['nodes']}
+        label_ids[i] = [labels[name] for name in info.labels if name in labels]
+        # Unlike with REST, labels that don't exist are not created
+        missing_labels = [name for name in info.labels if name not in labels]
+        if missing_labels:
+            logger.warning(
+                f"labels not found in '{info.full_pr_repo}', not adding them: {missing_labels}")
+        declarations.append(f'$in{i}: CreatePullRequestInput!')
+        selections.append(
+            f'p{i}: createPullRequest(input: $in{i}) {{ pullRequest {{ id url }} }}')
+        variables[f'in{i}'] = {
+            'repositoryId': repository['id'],
+            'baseRefName': info.branch_base,
+            'headRefName': info.branch_head,
+            'title': info.title,
+            'body': info.body,
+        }
+    if not selections:
+        return results
+    data, errors = _execute(transport, _document('mutation', declarations, selections), variables)
+
+    # Add labels and request reviews
+    declarations = []
+    selections = []
+    variables = {}
+    for i, info in enumerate(infos):
+        if results[i] is not None:
+            continue
+        created = data.get(f'p{i}')
+        if created is None:
+            results[i] = utils.EmailToPrError(
+                f"failed to create PR on '{info.full_pr_repo}': {errors.get(f'p{i}', '')}")
+            continue
+        pr = created['pullRequest']
+        results[i] = pr['url']
+        if label_ids.get(i):
+            declarations.append(f'$l{i}: AddLabelsToLabelableInput!')
+            selections.append(
+                f'l{i}: addLabelsToLabelable(input: $l{i}) {{ clientMutationId }}')
+            variables[f'l{i}'] = {'labelableId': pr['id'], 'labelIds': label_ids[i]}
+        reviewer_ids = [user_ids[login] for login in info.reviewers if login in user_ids]
+        missing_reviewers = [login for login in info.reviewers if login not in user_ids]
+        if missing_reviewers:
+            logger.warning(f'reviewers not found, not requesting them: {missing_reviewers}')
+        if reviewer_ids:
+            declarations.append(f'$v{i}: RequestReviewsInput!')
+            selections.append(f'v{i}: requestReviews(input: $v{i}) {{ clientMutationId }}')
+            variables[f'v{i}'] = {'pullRequestId': pr['id'], 'userIds': reviewer_ids}
+    if selections:
+        _, errors = _execute(
+            transport, _document('mutation', declarations, selections), variables)
+        for alias, message in errors.items():
+            # The PR exists, so don't fail it
+            logger.warning(f"failed to add labels or reviewers ('{alias}'): {message}")
+    return results
+
+
+def create_prs(
+    token: str,
+    infos: List[PrInfo],
+    batch_size: int = 10,
+    transport: Transport = None,
+    fallback: bool = True,
+) -> List[Union[str, Exception]]:
+    """
+    Create pull requests in batches using GraphQL, falling back on REST.
+
+    :param token: the token to access the GitHub API
+    :param infos: the pull requests info
+    :param batch_size: the maximum number of PRs per GraphQL request
+    :param transport: the GraphQL transport, or `None` to use the GitHub API
+    :param fallback: whether to retry failed PRs using the REST API
+    :return: the PR URL or the error, for each PR
+    """
+    transport = transport if transport is not None else http_transport(token)
+    results = []
+    for start in range(0, len(infos), batch_size):
+        chunk = infos[start:(start + batch_size)]
+        try:
+            chunk_results = _create_prs_graphql(transport, chunk)
+        except utils.EmailToPrError as e:
+            logger.warning(f'batched PR creation failed, falling back on REST: {e}')
+            chunk_results = [e] * len(chunk)
+        for info, result in zip(chunk, chunk_results):
+            if isinstance(result, Exception) and fallback:
+                try:
+                    result = create_pr(token, info)
+                except Exception as e:
+                    # Includes GithubException and connection errors
+                    result = utils.EmailToPrError('failed to create PR', e)
+            results.append(result)
+    return results
+
+
+class PrBatcher():
+    """
+    Collects PRs from concurrent jobs and creates them in batches.
+
+    Callers that may submit a PR should register first. A batch is sent as soon as every
+    registered caller is waiting for its PR, so a lone PR is not delayed; otherwise, it is sent
+    when it is full or after a delay.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        batch_size: int = 10,
+        delay_s: float = 0.5,
+        transport: Transport = None,
+    ) -> None:
+        """
+        Constructor.
+
+        :param token: the token to access the GitHub API
+        :param batch_size: the maximum number of PRs per batch
+        :param delay_s: the maximum time to wait for more PRs before sending a batch
+        :param transport: the GraphQL transport, or `None` to use the GitHub API
+        """
+        self._token = token
+        self._batch_size = max(1, batch_size)
+        self._delay_s = delay_s
+        self._transport = transport
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[PrInfo, Future]] = []
+        self._submitters = 0
+        self._timer = None
+
+    def _is_ready(self) -> bool:
+        """Check if pending PRs should be sent now, with the lock held."""
+        # Nobody else can add to the batch if all registered callers are waiting on it
+        return len(self._pending) >= min(self._batch_size, max(1, self._submitters))
+
+    def register(self) -> None:
+        """Register caller that may submit a PR."""
+        with self._lock:
+            self._submitters += 1
+
+    def unregister(self) -> None:
+        """Unregister caller, e.g. once it got its PR or if it won't submit one."""
+        with self._lock:
+            self._submitters = max(0, self._submitters - 1)
+            batch = self._take() if self._pending and self._is_ready() else None
+        if batch:
+            self._send(batch)
+
+    def submit(self, info: PrInfo) -> Future:
+        """
+        Queue PR for creation.
+
+        :param info: the pull request info
+        :return: the future PR URL
+        """
+        future = Future()
+        with self._lock:
+            self._pending.append((info, future))
+            if self._is_ready():
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self._delay_s, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._send(batch)
+        return future
+
+    def create_pr(self, info: PrInfo) -> str:
+        """
+        Create PR as part of a batch and wait for the result.
+
+        :param info: the pull request info
+        :return: the pull request URL
+        """
+        return self.submit(info).result()
+
+    def _take(self) -> List[Tuple[PrInfo, Future]]:
+        """Take pending PRs, with the lock held."""
+        batch = self._pending
+        self._pending = []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def flush(self) -> None:
+        """Send pending PRs now."""
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch: List[Tuple[PrInfo, Future]]) -> None:
+        infos = [info for info, _ in batch]
+        try:
+            results = create_prs(self._token, infos, self._batch_size, self._transport)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
 def add_args(parser: argparse.ArgumentParser) -> None:
     """Add github args."""
     parser.add_argument(
         'github_token',
         help='the token to use to access the GitHub API')
+
+
+def add_batch_args(parser: argparse.ArgumentParser) -> None:
+    """Add PR batching args."""
+    parser.add_argument(
+        '--pr-batch-size',
+        help='the maximum number of PRs created per GraphQL request, or 0 to only use the '
+        'REST API (default: %(default)s)',
+        type=int,
+        default=10)
+    parser.add_argument(
+        '--pr-batch-delay',
+        help='the maximum number of seconds to wait for PRs of other emails before creating a '
+        'batch (default: %(default)s)',
+        type=float,
+        default=0.5)
+    parser.add_argument(
+        '--github-graphql-url',
+        help='the GitHub GraphQL API endpoint (default: %(default)s)',
+        default=GRAPHQL_URL)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get parser."""
+    parser = argparse.ArgumentParser(
+        description='Create GitHub PRs.',
+        add_help=False)
+    add_batch_args(parser)
+    return parser
+
+
+def from_params(params: Any) -> Union[PrBatcher, None]:
+    """
+    Create PR batcher from parameters.
+
+    :param params: the parameters container
+    :return: the batcher, or `None` if only the REST API should be used
+    """
+    batch_size = int(utils.get_param(params, 'pr_batch_size', 10))
+    if batch_size <= 0:
+        return None
+    return PrBatcher(
+        params.repo_token,
+        batch_size=batch_size,
+        delay_s=float(utils.get_param(params, 'pr_batch_delay', 0.5)),
+        transport=http_transport(
+            params.repo_token, utils.get_param(params, 'github_graphql_url', GRAPHQL_URL)),
+    )
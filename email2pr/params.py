@@ -1,11 +1,13 @@
 """Module for parameter file wrapper and parsing."""
 
-import yaml
+import logging
 from typing import List
 from typing import Union
 
 from . import utils
 
+logger = logging.getLogger(__name__)
+
 
 class Params():
     """Parameters wrappers."""
@@ -29,10 +31,13 @@ class Params():
 
         :param filename: the name of the file to parse
         """
+        # Only imported when a parameters file is used
+        import yaml
         content = open(filename, 'r').read()
-        for data in yaml.load_all(content):
+        for data in yaml.safe_load_all(content):
             self.params = {**self.params, **data}
-        print(f'parameters: {self.params}')
+        # Only log names, since values include credentials
+        logger.debug(f'parameters: {sorted(self.params)}')
     
     def _assert_file_parsed(self) -> None:
         """Assert that the parameters file has been parsed."""
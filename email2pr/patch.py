@@ -1,9 +1,44 @@
 """Module for converting emails to patch files."""
 
+import hashlib
 import os
+import re
 from email.message import EmailMessage
 from typing import Tuple
 
+_PATCH_SUBJECT_RE = re.compile(r'^\s*\[[^\]]*PATCH[^\]]*\]')
+
+
+def is_patch_subject(subject: str) -> bool:
+    """
+    Check if an email subject is the subject of a patch email.
+
+    Replies (e.g. 'Re: [PATCH] ...') are not patches.
+
+    :param subject: the email subject
+    :return: `True` if it is a patch subject, `False` otherwise
+    """
+    return _PATCH_SUBJECT_RE.match(subject) is not None
+
+
+def get_branch_key(
+    subject: str,
+    sender: str,
+) -> str:
+    """
+    Get key that deterministically identifies a patch, e.g. to name its branch.
+
+    It only depends on the subject without its '[PATCH ...]' prefix and on the sender
+    address, so sending a revised version of a patch gives the same key, and its branch and
+    PR can be updated.
+
+    :param subject: the email subject
+    :param sender: the address of the sender of the email
+    :return: a short hash of the normalized subject and sender
+    """
+    title = ' '.join(_PATCH_SUBJECT_RE.sub('', subject).split()).lower()
+    return hashlib.sha1(f'{title}\n{sender.lower()}'.encode('utf-8')).hexdigest()[:12]
+
 
 def _get_patch_index(subject: str) -> Tuple[int, int]:
     """
@@ -17,11 +52,11 @@ def _get_patch_index(subject: str) -> Tuple[int, int]:
     bracket_open = subject.find('[', 0, patch_start)
     bracket_close = subject.find(']', bracket_open)
     patch_string = subject[(bracket_open + 1):bracket_close]
-    # No numbers if there's only one
-    if patch_string == 'PATCH':
+    # No numbers if there's only one, e.g. '[PATCH]' or '[PATCH v2]'
+    patch_number_sep = patch_string.find('/')
+    if patch_number_sep == -1:
         return 1, 1
     else:
-        patch_number_sep = patch_string.find('/')
         index = int(patch_string[patch_number_sep - 1])
         total = int(patch_string[patch_number_sep + 1])
         return index, total
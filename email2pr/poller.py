@@ -1,18 +1,118 @@
 """Module for email polling."""
 
 import argparse
+import fcntl
+import imaplib
+import json
+import logging
+import os
+import re
+import threading
 import time
+import zlib
+from contextlib import contextmanager
+from email import policy
+from email.parser import BytesHeaderParser
 from imaplib import IMAP4_SSL
 from imaplib import IMAP4_SSL_PORT
 from typing import Any
 from typing import Callable
+from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Set
 from typing import Tuple
 from typing import Union
 
+from . import log
 from . import patch
 from . import utils
 
+logger = logging.getLogger(__name__)
+
+# COMPRESS (RFC 4978) is not known to imaplib
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+DEFAULT_STATE_FILE = os.path.join('~', '.email2pr', 'state.json')
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024
+DEFAULT_MAX_ATTEMPTS = 3
+
+_UID_RE = re.compile(rb'UID (\d+)')
+_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+
+
+class DeflateMixin():
+    """
+    Add COMPRESS=DEFLATE (RFC 4978) support to an IMAP4 connection.
+
+    Once enabled, everything sent and received is compressed with raw deflate.
+    """
+
+    _compressor = None
+    _decompressor = None
+    _inbuf = b''
+
+    def compress(self) -> bool:
+        """
+        Enable compression, if the server supports it.
+
+        This should be called after login, since servers may only advertise it then.
+
+        :return: `True` if compression is enabled, `False` otherwise
+        """
+        result, data = self.capability()
+        if result == 'OK' and data and data[-1]:
+            self.capabilities = tuple(data[-1].decode('ascii').upper().split())
+        if 'COMPRESS=DEFLATE' not in self.capabilities:
+            return False
+        result, _ = self._simple_command('COMPRESS', 'DEFLATE')
+        if result != 'OK':
+            return False
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self._inbuf = b''
+        return True
+
+    def _fill(self) -> None:
+        """Read and decompress more data from the socket."""
+        data = self.sock.recv(65536)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self._inbuf += self._decompressor.decompress(data)
+
+    def read(self, size: int) -> bytes:
+        if self._decompressor is None:
+            return super().read(size)
+        while len(self._inbuf) < size:
+            self._fill()
+        data, self._inbuf = self._inbuf[:size], self._inbuf[size:]
+        return data
+
+    def readline(self) -> bytes:
+        if self._decompressor is None:
+            return super().readline()
+        while True:
+            index = self._inbuf.find(b'\n')
+            if index >= 0:
+                break
+            if len(self._inbuf) > imaplib._MAXLINE:
+                raise self.error(f'got more than {imaplib._MAXLINE} bytes')
+            self._fill()
+        line, self._inbuf = self._inbuf[:(index + 1)], self._inbuf[(index + 1):]
+        return line
+
+    def send(self, data: bytes) -> None:
+        if self._compressor is None:
+            return super().send(data)
+        self.sock.sendall(
+            self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+class DeflateIMAP4_SSL(DeflateMixin, IMAP4_SSL):
+    """IMAP4 over SSL connection with COMPRESS=DEFLATE support."""
+
+    pass
+
 
 class EmailConnectionInfo():
     """Email connection information wrapper."""
@@ -26,6 +126,119 @@ class EmailConnectionInfo():
         self.passw = params.email_pass
         self.host = params.email_host if params.email_host is not None else 'imap.gmail.com'
         self.port = params.email_port if params.email_port is not None else IMAP4_SSL_PORT
+        self.compress = utils.get_param(params, 'email_compress', True)
+        self.max_size = int(utils.get_param(params, 'email_max_size', DEFAULT_MAX_SIZE))
+
+
+class EmailMetadata():
+    """Information about an email that can be fetched without its body."""
+
+    def __init__(
+        self,
+        uid: bytes,
+        size: int,
+        subject: str,
+    ) -> None:
+        """
+        Constructor.
+
+        :param uid: the email UID
+        :param size: the size of the full email, in bytes
+        :param subject: the email subject
+        """
+        self.uid = uid
+        self.size = size
+        self.subject = subject
+
+
+class Checkpoint():
+    """
+    Persisted UID of the last processed email, and state of newer emails.
+
+    Newer emails are either waiting to be retried after failed attempts, or already done,
+    e.g. when an older email failed.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_STATE_FILE,
+    ) -> None:
+        """
+        Constructor.
+
+        :param path: the file in which to store the checkpoint
+        """
+        self._path = os.path.expanduser(path)
+
+    def load(self) -> Tuple[Union[int, None], Union[int, None], Dict[int, int], Set[int]]:
+        """
+        Load checkpoint.
+
+        :return: (the last UID, the UIDVALIDITY of the mailbox,
+            the number of failed attempts of emails to retry, by UID,
+            the UIDs of newer emails that are done),
+            or (`None`, `None`, {}, set()) if there is no valid checkpoint
+        """
+        try:
+            with open(self._path, 'r') as f:
+                state = json.load(f)
+            attempts = {int(uid): int(n) for uid, n in state.get('attempts', {}).items()}
+            done = {int(uid) for uid in state.get('done', [])}
+            return int(state['uid']), state.get('uidvalidity'), attempts, done
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None, None, {}, set()
+
+    def save(
+        self,
+        uid: int,
+        uidvalidity: Union[int, None],
+        attempts: Dict[int, int] = None,
+        done: Set[int] = None,
+    ) -> None:
+        """
+        Save checkpoint.
+
+        :param uid: the last UID
+        :param uidvalidity: the UIDVALIDITY of the mailbox
+        :param attempts: the number of failed attempts of emails to retry, by UID
+        :param done: the UIDs of newer emails that are done
+        """
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write then rename, so that the file is never partially written
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'uid': uid,
+                'uidvalidity': uidvalidity,
+                'attempts': {str(k): v for k, v in (attempts or {}).items()},
+                'done': sorted(done or []),
+            }, f)
+        os.replace(tmp_path, self._path)
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """
+        Lock checkpoint in this context, so that only one process uses it at a time.
+
+        This keeps overlapping runs (e.g. from cron) from processing the same emails
+        and from sharing repo clones.
+
+        :raise EmailToPrError: if another process holds the lock
+        """
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self._path + '.lock', 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                raise utils.EmailToPrError(f"'{self._path}' is used by another process", e)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
 class EmailPoller():
@@ -34,39 +247,110 @@ class EmailPoller():
     def __init__(
         self,
         email_info: EmailConnectionInfo,
-        callback: Callable[[List[Any]], None],
+        callback: Callable[[int, List[Any]], None],
         search_args: Tuple[Union[str, None], str] = (None, 'ALL'),
+        checkpoint: Checkpoint = None,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
     ) -> None:
-        """Constructor."""
+        """
+        Constructor.
+
+        :param email_info: the email connection information
+        :param callback: the function to call with the uid and the raw data of each new email;
+            done() should be called with the uid once the email is processed
+        :param search_args: the search criteria for emails
+        :param checkpoint: the checkpoint used to resume from the last processed email,
+            or `None` to always start from the latest email
+        :param max_attempts: the number of times an email is processed before giving up on it
+        """
         self._info = email_info
         self._callback = callback
         self._search_args = search_args
+        self._checkpoint = checkpoint
+        self._max_attempts = max(1, max_attempts)
+        self._uidvalidity = None
+        self._lock = threading.Lock()
+        # UID of the newest email that was handed off or skipped
+        self._last_uid = 0
+        self._in_flight: Set[int] = set()
+        self._attempts: Dict[int, int] = {}
+        self._retries: Set[int] = set()
+        # Emails after the checkpoint that don't need to be processed again
+        self._done: Set[int] = set()
 
     def _get_server(self) -> IMAP4_SSL:
         """Login and return server object."""
-        server = IMAP4_SSL(self._info.host, self._info.port)
+        server = DeflateIMAP4_SSL(self._info.host, self._info.port)
         result, _ = server.login(self._info.user, self._info.passw)
         assert result == 'OK', 'login failed!'
+        if self._info.compress:
+            compressed = server.compress()
+            logger.debug(f'compression enabled: {compressed}')
         return server
 
-    def _get_email_uids(self) -> List[bytes]:
-        """Get all email uids."""
+    def _get_email_uids(self, min_uid: int = None) -> List[bytes]:
+        """
+        Get all email uids.
+
+        :param min_uid: the minimum uid, or `None` to get all of them
+        :return: the uids
+        """
         server = self._get_server()
         server.select('"[Gmail]/All Mail"')
+        _, validity = server.response('UIDVALIDITY')
+        if validity and validity[0]:
+            self._uidvalidity = int(validity[0])
         arg_first, arg_second = self._search_args
-        result, data = server.uid('search', arg_first, arg_second)
+        uid_range = f'UID {min_uid}:*' if min_uid is not None else None
+        result, data = server.uid('search', uid_range, arg_first, arg_second)
         assert result == 'OK', 'uid() failed!'
         ids = data[0].split()
         server.logout()
+        # 'n:*' always includes the latest email, even if its uid is lower than n
+        if min_uid is not None:
+            ids = [uid for uid in ids if int(uid) >= min_uid]
         return ids
 
-    def _get_latest_uid(self) -> bytes:
-        """Get latest email uid."""
-        ids = self._get_email_uids()
-        return max(ids)
+    def _get_emails_metadata(self, uids: List[bytes]) -> Dict[bytes, EmailMetadata]:
+        """
+        Get size and subject of emails, without fetching their bodies.
+
+        :param uids: the email uids
+        :return: the metadata, by uid
+        """
+        server = self._get_server()
+        server.select('"[Gmail]/All Mail"')
+        result, data = server.uid(
+            'fetch',
+            b','.join(uids).decode('ascii'),
+            '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (SUBJECT)])',
+        )
+        assert result == 'OK', 'uid() failed!'
+        server.logout()
+        metadata = {}
+        parser = BytesHeaderParser(policy=policy.default)
+        for item in data:
+            if not isinstance(item, tuple):
+                continue
+            uid_match = _UID_RE.search(item[0])
+            size_match = _SIZE_RE.search(item[0])
+            if uid_match is None or size_match is None:
+                continue
+            uid = uid_match.group(1)
+            headers = parser.parsebytes(item[1])
+            metadata[uid] = EmailMetadata(
+                uid, int(size_match.group(1)), str(headers.get('subject', '')))
+        return metadata
 
     def _get_email_from_uid(self, uid: bytes) -> List[Any]:
-        """Get an email corresponding to a uid."""
+        """
+        Get an email corresponding to a uid.
+
+        The whole email is fetched in one request, so its size should be checked first.
+
+        :param uid: the email uid
+        :return: the raw fetch data
+        """
         server = self._get_server()
         server.select('"[Gmail]/All Mail"')
         result, data = server.uid('fetch', uid, '(RFC822)')
@@ -74,8 +358,163 @@ class EmailPoller():
         server.logout()
         return data
 
-    def _process_new_email(self, raw_email_data: List[Any]) -> None:
-        self._callback(raw_email_data)
+    def _should_fetch(self, metadata: Union[EmailMetadata, None]) -> bool:
+        """Check if an email should be fetched, based on its metadata."""
+        if metadata is None:
+            return True
+        if metadata.size > self._info.max_size:
+            logger.warning(
+                f'skipping email too big: {metadata.size} bytes',
+                extra={'uid': metadata.uid.decode('ascii'), 'size': metadata.size},
+            )
+            return False
+        if not patch.is_patch_subject(metadata.subject):
+            logger.info(
+                f"skipping email that isn't a patch: '{metadata.subject}'",
+                extra={'uid': metadata.uid.decode('ascii')},
+            )
+            return False
+        return True
+
+    def _process_new_email(self, uid: int, raw_email_data: List[Any]) -> None:
+        self._callback(uid, raw_email_data)
+
+    def _save_checkpoint(self) -> None:
+        """Save checkpoint, with the lock held."""
+        if self._checkpoint is None:
+            return
+        # Don't move past emails that are still being processed or that will be retried
+        pending = self._in_flight | set(self._attempts)
+        uid = min(pending) - 1 if pending else self._last_uid
+        self._done = {done_uid for done_uid in self._done if done_uid > uid}
+        self._checkpoint.save(uid, self._uidvalidity, self._attempts, self._done)
+
+    def done(self, uid: int, success: bool) -> None:
+        """
+        Mark email as processed, so that the checkpoint can move past it.
+
+        Failed emails are processed again until the maximum number of attempts is reached,
+        by the poll loop or by the next run with poll_once().
+
+        :param uid: the email uid
+        :param success: whether processing succeeded
+        """
+        with self._lock:
+            self._in_flight.discard(uid)
+            if success:
+                self._attempts.pop(uid, None)
+                self._done.add(uid)
+            else:
+                attempts = self._attempts.get(uid, 0) + 1
+                if attempts < self._max_attempts:
+                    self._attempts[uid] = attempts
+                    self._retries.add(uid)
+                else:
+                    logger.warning(
+                        f'giving up on email after {attempts} attempt(s)',
+                        extra={'uid': str(uid)},
+                    )
+                    self._attempts.pop(uid, None)
+                    self._done.add(uid)
+            self._save_checkpoint()
+
+    def _resume(
+        self,
+        last_uid: int,
+        attempts: Dict[int, int],
+        done: Set[int],
+        uids: List[bytes],
+    ) -> None:
+        """
+        Resume from checkpoint.
+
+        :param last_uid: the uid of the checkpoint
+        :param attempts: the number of failed attempts of emails to retry, by uid
+        :param done: the uids of emails newer than the checkpoint that are done
+        :param uids: the uids of the emails newer than the checkpoint, so that emails that
+            are gone (e.g. deleted) aren't waited on
+        """
+        found = {int(uid) for uid in uids}
+        with self._lock:
+            self._last_uid = last_uid
+            self._attempts = {uid: n for uid, n in attempts.items() if uid in found}
+            self._done = done & found
+
+    def _start(self) -> None:
+        """Start after the checkpoint if it is still valid, otherwise after the latest email."""
+        logger.info('getting latest email..')
+        uids = self._get_email_uids()
+        if self._checkpoint is not None:
+            uid, uidvalidity, attempts, done = self._checkpoint.load()
+            if uid is not None and uidvalidity == self._uidvalidity:
+                logger.info(f'resuming from checkpoint: {uid}')
+                self._resume(uid, attempts, done, [u for u in uids if int(u) > uid])
+                return
+        with self._lock:
+            self._last_uid = max((int(uid) for uid in uids), default=0)
+            self._attempts = {}
+            self._done = set()
+            self._save_checkpoint()
+
+    def _process_new_emails(self, uids: List[bytes]) -> int:
+        """
+        Fetch emails and hand them off for processing.
+
+        The checkpoint only moves past an email once done() is called for it.
+        Emails that are already done are skipped.
+
+        :param uids: the uids of the emails, in increasing order
+        :return: the number of emails handed off
+        """
+        if not uids:
+            return 0
+        count = 0
+        with self._lock:
+            new_uids = [uid for uid in uids if int(uid) not in self._done]
+        metadata = self._get_emails_metadata(new_uids) if new_uids else {}
+        for uid in uids:
+            raw_email_data = None
+            if uid in new_uids and self._should_fetch(metadata.get(uid)):
+                raw_email_data = self._get_email_from_uid(uid)
+            with self._lock:
+                if raw_email_data is not None:
+                    self._in_flight.add(int(uid))
+                else:
+                    self._done.add(int(uid))
+                self._last_uid = max(self._last_uid, int(uid))
+                self._save_checkpoint()
+            if raw_email_data is not None:
+                try:
+                    self._process_new_email(int(uid), raw_email_data)
+                except Exception:
+                    self.done(int(uid), False)
+                    raise
+                count += 1
+        return count
+
+    def poll_once(self) -> int:
+        """
+        Hand off new emails since the checkpoint, then return.
+
+        Emails that failed before are handed off again, since the checkpoint is still before them,
+        but newer emails that are already done are not.
+        If there is no valid checkpoint, only the checkpoint is created.
+        When there is no new email, this only needs one connection to the server.
+
+        :return: the number of emails handed off
+        """
+        last_uid, uidvalidity, attempts, done = self._checkpoint.load() \
+            if self._checkpoint is not None else (None, None, {}, set())
+        if last_uid is None:
+            self._start()
+            return 0
+        uids = self._get_email_uids(min_uid=last_uid + 1)
+        if uidvalidity != self._uidvalidity:
+            logger.warning('mailbox UIDVALIDITY changed, resetting checkpoint')
+            self._start()
+            return 0
+        self._resume(last_uid, attempts, done, uids)
+        return self._process_new_emails(sorted(uids, key=int))
 
     def poll(self, period_s: int = 5) -> None:
         """
@@ -83,21 +522,16 @@ class EmailPoller():
 
         :param period_seconds: the number of seconds to wait before polling again
         """
-        # Get uid of latest email
-        print('getting latest email..')
-        last_uid = self._get_latest_uid()
+        self._start()
 
         while True:
-            print('polling emails..')
+            logger.debug('polling emails..')
 
-            # Get all emails
-            uids = self._get_email_uids()
-            for uid in uids:
-                # Check if new
-                if uid > last_uid:
-                    last_uid = uid
-                    raw_email_data = self._get_email_from_uid(uid)
-                    self._process_new_email(raw_email_data)
+            uids = self._get_email_uids(min_uid=self._last_uid + 1)
+            with self._lock:
+                uids += [str(uid).encode('ascii') for uid in self._retries]
+                self._retries.clear()
+            self._process_new_emails(sorted(set(uids), key=int))
 
             time.sleep(period_s)
 
@@ -118,6 +552,26 @@ def add_args(parser: argparse.ArgumentParser) -> None:
         '--email-port', '-p',
         help='the port number (default: %(default)s)',
         default=IMAP4_SSL_PORT)
+    parser.add_argument(
+        '--no-email-compress',
+        help='do not use COMPRESS=DEFLATE even if the server supports it',
+        dest='email_compress',
+        action='store_false')
+    parser.add_argument(
+        '--email-max-size',
+        help='the maximum size of emails to process, in bytes (default: %(default)s)',
+        type=int,
+        default=DEFAULT_MAX_SIZE)
+    parser.add_argument(
+        '--email-max-attempts',
+        help='the number of times an email is processed before giving up on it '
+        '(default: %(default)s)',
+        type=int,
+        default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument(
+        '--state-file',
+        help='the file in which to store the last processed email (default: %(default)s)',
+        default=DEFAULT_STATE_FILE)
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -134,8 +588,8 @@ def parse_args() -> Any:
     return get_parser().parse_args()
 
 
-def _test_callback(raw_email_data: List[Any]) -> None:
-    print(f'===new email!====')
+def _test_callback(uid: int, raw_email_data: List[Any]) -> None:
+    logger.info('new email', extra={'uid': str(uid)})
     msg = utils.email_from_raw_data(raw_email_data)
     patch.from_email(msg, '/tmp')
 
@@ -143,6 +597,7 @@ def _test_callback(raw_email_data: List[Any]) -> None:
 def main() -> None:
     """Email polling entrypoint for testing."""
     args = parse_args()
+    log.setup(secrets=[args.email_pass])
     info = EmailConnectionInfo(args)
     poller = EmailPoller(
         info,
@@ -0,0 +1,280 @@
+"""Module for profiling email processing."""
+
+import argparse
+import cProfile
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from email.message import EmailMessage
+from typing import Any
+from typing import Iterator
+from typing import List
+from typing import Union
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = '/tmp/email2pr-profiles'
+_UNSAFE_CHARS_RE = re.compile(r'[^A-Za-z0-9._-]+')
+
+_context = threading.local()
+
+
+def _label(*parts: Union[str, None]) -> str:
+    """Get label that can be used in a file name."""
+    return '-'.join(_UNSAFE_CHARS_RE.sub('_', part) for part in parts if part)
+
+
+def get_profiles() -> Union[List[cProfile.Profile], None]:
+    """Get profilers of the job being profiled by the current thread, or `None`."""
+    return getattr(_context, 'profiles', None)
+
+
+@contextmanager
+def profile_thread(profiles: Union[List[cProfile.Profile], None]) -> Iterator[None]:
+    """
+    Profile the current thread as part of a job profiled by another thread.
+
+    cProfile only profiles the thread that enabled it, so work handed off to other threads
+    needs its own profiler. Its stats are merged into the profile of the job.
+
+    :param profiles: the profilers of the job, from get_profiles(), or `None` to do nothing
+    """
+    profiler = None
+    if profiles is not None:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            profiles.append(profiler)
+        except ValueError:
+            # Profilers are process-wide with Python >= 3.12, so the job's profiler already
+            # covers this thread
+            profiler = None
+    previous = get_profiles()
+    _context.profiles = profiles
+    try:
+        yield
+    finally:
+        _context.profiles = previous
+        if profiler is not None:
+            profiler.disable()
+
+
+class JobProfiler():
+    """Profile CPU time and allocations of individual jobs."""
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_DIR,
+        profile_all: bool = False,
+        sample_rate: float = 0.0,
+    ) -> None:
+        """
+        Constructor.
+
+        :param directory: the directory in which to write profiles
+        :param profile_all: whether to profile every job
+        :param sample_rate: the fraction of jobs to profile, between 0 and 1
+        """
+        self._dir = directory
+        self._profile_all = profile_all
+        self._sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._tracing_jobs = 0
+
+    def should_profile(self, msg: EmailMessage) -> bool:
+        """
+        Check if the job for an email should be profiled.
+
+        :param msg: the email message
+        :return: `True` if enabled for all jobs, if the email requests it, or if sampled
+        """
+        if self._profile_all:
+            return True
+        if utils.get_profile_requested(msg.get_payload()):
+            return True
+        return self._sample_rate > 0.0 and random.random() < self._sample_rate
+
+    def _start_tracemalloc(self) -> None:
+        with self._lock:
+            self._tracing_jobs += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def _stop_tracemalloc(self) -> tracemalloc.Snapshot:
+        with self._lock:
+            snapshot = tracemalloc.take_snapshot()
+            self._tracing_jobs -= 1
+            if self._tracing_jobs == 0:
+                tracemalloc.stop()
+            return snapshot
+
+    @contextmanager
+    def profile(
+        self,
+        uid: Union[str, None],
+        repo_name: Union[str, None],
+        job_id: Union[str, None] = None,
+    ) -> Iterator[None]:
+        """
+        Profile the code run by the current thread in this context.
+
+        Other threads doing work for the job should use profile_thread() with the profilers
+        from get_profiles(), so that their work is included.
+        Writes a cProfile file (.prof) and a tracemalloc snapshot (.tracemalloc).
+        Since tracemalloc is process-wide, the snapshot also includes allocations made
+        by other jobs running at the same time. With Python >= 3.12, only one profiler can be
+        active at a time, so the .prof file is skipped if another job is being profiled.
+
+        :param uid: the UID of the email
+        :param repo_name: the name of the target repo
+        :param job_id: the job ID
+        """
+        os.makedirs(self._dir, exist_ok=True)
+        base = os.path.join(
+            self._dir, _label(time.strftime('%Y%m%d%H%M%S'), uid, repo_name, job_id))
+        profiler = cProfile.Profile()
+        profiles = None
+        previous = get_profiles()
+        self._start_tracemalloc()
+        try:
+            try:
+                profiler.enable()
+                profiles = [profiler]
+            except ValueError as e:
+                # Don't fail the job just because it can't be profiled
+                logger.warning(f'not profiling with cProfile: {e}')
+            _context.profiles = profiles
+            yield
+        finally:
+            if profiles is not None:
+                profiler.disable()
+            _context.profiles = previous
+            snapshot = self._stop_tracemalloc()
+            paths = {'snapshot_path': base + '.tracemalloc'}
+            if profiles is not None:
+                pstats.Stats(*profiles).dump_stats(base + '.prof')
+                paths['profile_path'] = base + '.prof'
+            snapshot.dump(base + '.tracemalloc')
+            logger.info(f'profile written: {base}', extra=paths)
+
+
+class SamplingProfiler():
+    """
+    Wall-clock sampling profiler for one thread.
+
+    Samples are written in the collapsed stack format, which can be given to flamegraph.pl.
+    Unlike cProfile, this has a low overhead and also counts time spent waiting (e.g. on
+    network or sleeping), so it can run for the lifetime of the poll loop.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        thread_id: int = None,
+        interval_s: float = 0.01,
+    ) -> None:
+        """
+        Constructor.
+
+        :param path: the file in which to write the samples
+        :param thread_id: the ID of the thread to sample, or `None` for the current thread
+        :param interval_s: the time between samples
+        """
+        self._path = path
+        self._thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self._interval_s = interval_s
+        self._samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='email2pr-sampler', daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval_s):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self._samples[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        """Start sampling."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling and write samples."""
+        self._stop.set()
+        self._thread.join()
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self._path, 'w') as f:
+            for stack, count in self._samples.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info(
+            f'sampling profile written: {self._path}',
+            extra={'profile_path': self._path, 'samples': sum(self._samples.values())},
+        )
+
+    def __enter__(self) -> 'SamplingProfiler':
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+
+def add_args(parser: argparse.ArgumentParser) -> None:
+    """Add profiling args."""
+    parser.add_argument(
+        '--profile',
+        help='profile every email with cProfile and tracemalloc',
+        action='store_true')
+    parser.add_argument(
+        '--profile-sample-rate',
+        help='the fraction of emails to profile, between 0 and 1 (default: %(default)s)',
+        type=float,
+        default=0.0)
+    parser.add_argument(
+        '--profile-poll',
+        help='profile the poll loop with a sampling profiler',
+        action='store_true')
+    parser.add_argument(
+        '--profile-dir',
+        help='the directory in which to write profiles (default: %(default)s)',
+        default=DEFAULT_DIR)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get parser."""
+    parser = argparse.ArgumentParser(
+        description='Profile email processing.',
+        add_help=False)
+    add_args(parser)
+    return parser
+
+
+def from_params(params: Any) -> JobProfiler:
+    """
+    Create job profiler from parameters.
+
+    :param params: the parameters container
+    :return: the profiler
+    """
+    return JobProfiler(
+        directory=utils.get_param(params, 'profile_dir', DEFAULT_DIR),
+        profile_all=bool(utils.get_param(params, 'profile', False)),
+        sample_rate=float(utils.get_param(params, 'profile_sample_rate', 0.0)),
+    )
@@ -1,20 +1,29 @@
 """Module for dealing with git repos."""
 
 import argparse
+import logging
 import os
 import shlex
+import shutil
 import subprocess
-import time
+import threading
 from email.message import EmailMessage
 from typing import Any
+from typing import Dict
+from typing import List
 from typing import Tuple
+from typing import TYPE_CHECKING
 from typing import Union
 
-from git import GitError
-from git import Repo
-
+from . import log
 from . import utils
 
+# Only imported when needed, so that e.g. the parser can be used without loading git
+if TYPE_CHECKING:
+    from git import Repo
+
+logger = logging.getLogger(__name__)
+
 
 class RepoInfo():
     """Repo information container."""
@@ -38,16 +47,22 @@ class RepoInfo():
         self.url = utils.add_git_suffix(url)
         self.branch = base_branch
         self.name = name if name is not None else self._get_name_from_url(self.url)
-        self.repo_path = self._get_repo_path(self.dir, self.name)
+        self.owner = self._get_owner_from_url(self.url)
+        self.repo_path = self._get_repo_path(self.dir, self.owner, self.name)
 
     def _get_name_from_url(self, url: str) -> str:
         last_slash = url.rfind('/')
         name = url[(last_slash + 1):]
         name = utils.strip_git_suffix(name)
         return name
-    
-    def _get_repo_path(self, directory: str, name: str) -> str:
-        return os.path.join(directory, name)
+
+    def _get_owner_from_url(self, url: str) -> str:
+        parts = url.split('/')
+        return parts[-2] if len(parts) >= 2 else ''
+
+    def _get_repo_path(self, directory: str, owner: str, name: str) -> str:
+        # Include owner so that forks/mirrors with the same name don't collide
+        return os.path.join(directory, owner, name)
 
 
 class RepoManager():
@@ -63,75 +78,146 @@ class RepoManager():
         :param params: the parameters container
         """
         self._params = params
+        self._worktree_locks_lock = threading.Lock()
+        self._worktree_locks: Dict[str, threading.Lock] = {}
+
+    def _worktree_lock(self, repo: 'Repo') -> threading.Lock:
+        """
+        Get lock for adding or removing worktrees of a repo.
+
+        Git doesn't support doing this concurrently, since it modifies shared files.
+        """
+        with self._worktree_locks_lock:
+            return self._worktree_locks.setdefault(repo.working_dir, threading.Lock())
+
+    @property
+    def repo_dir(self) -> str:
+        return self._params.repo_dir if self._params.repo_dir is not None else '/tmp/repos'
 
     def _clone(
         self,
         info: RepoInfo,
-    ) -> Union[Repo, None]:
+    ) -> 'Repo':
         """
-        Clone a new repo, selecting a specific branch if given.
+        Clone a new repo, or fetch it if it was already cloned.
+
+        All branches are fetched, so that one clone can be shared by all base branches.
 
         :param info: the information of the repo to clone
-        :return: the cloned repo object, or `None` if it failed
+        :return: the cloned repo object
         """
-        print(f"cloning repo '{info.name}' to: {info.repo_path}")
-        repo = None
+        from git import GitError
+        from git import Repo
         try:
-            # If branch is not specified, we'll use the default branch
-            if info.branch is None:
-                repo = Repo.clone_from(info.url, info.repo_path)
-            else:
-                repo = Repo.clone_from(info.url, info.repo_path, branch=info.branch)
-            return repo
+            if os.path.isdir(os.path.join(info.repo_path, '.git')):
+                logger.info(f"fetching repo '{info.name}' in: {info.repo_path}")
+                repo = Repo(info.repo_path)
+                repo.remotes.origin.set_url(info.url)
+                repo.remotes.origin.fetch(prune=True)
+                repo.git.worktree('prune')
+                return repo
+            logger.info(f"cloning repo '{info.name}' to: {info.repo_path}")
+            return Repo.clone_from(info.url, info.repo_path)
         except GitError as e:
             raise utils.EmailToPrError('failed to clone repo', e)
 
-    def clone_from_email(
+    def targets_from_email(
         self,
         msg: EmailMessage,
-    ) -> Tuple[Union[Repo, None], Union[RepoInfo, None]]:
+    ) -> List[RepoInfo]:
         """
-        Clone repo corresponding to email and checkout base branch.
+        Get all repo and base branch combinations targeted by an email.
+
+        Every repo URL is combined with every base branch, so that a patch can be sent to
+        multiple branches of a repo, or to the same branch of multiple repos.
 
         :param msg: the email message
-        :return: (repo, repo information) or (`None`, `None`) if email has no URL
-        """
-        # URL is mandatory
-        url = utils.get_repo_url(msg.get_payload())
-        if url is None:
-            return None, None
-        # Insert username and password into URL
-        url = utils.insert_token_in_remote_url(
-            url,
-            self._params.repo_user,
-            self._params.repo_token)
-        # Base branch is not mandatory
-        base_branch = utils.get_base_branch(msg.get_payload())
-        info = RepoInfo(self._params.repo_dir, url, base_branch)
-        return self._clone(info), info
-
-    def _checkout_new_branch(
+        :return: the list of targets, empty if the email has no URL
+        """
+        # URL is mandatory, base branch is not
+        urls = utils.get_repo_urls(msg.get_payload())
+        base_branches = utils.get_base_branches(msg.get_payload()) or [None]
+        targets = []
+        for url in urls:
+            # Insert username and password into URL
+            url = utils.insert_token_in_remote_url(
+                url.rstrip('/'),
+                self._params.repo_user,
+                self._params.repo_token)
+            for base_branch in base_branches:
+                targets.append(RepoInfo(self.repo_dir, url, base_branch))
+        return targets
+
+    def fetch(
         self,
-        repo: Repo,
-    ) -> Tuple[str, str]:
+        info: RepoInfo,
+    ) -> 'Repo':
+        """
+        Clone or fetch repo.
+
+        :param info: the information of the repo
+        :return: the repo object
         """
-        Create and checkout new branch from current branch.
+        return self._clone(info)
+
+    def get_default_branch(
+        self,
+        repo: 'Repo',
+    ) -> str:
+        """
+        Get name of the default branch of the remote.
 
         :param repo: the repo object
-        :return: (the name of the new branch on which to apply the patch,
+        :return: the branch name
+        """
+        ref = repo.git.symbolic_ref('refs/remotes/origin/HEAD', '--short')
+        return ref[len('origin/'):] if ref.startswith('origin/') else ref
+
+    def _add_worktree(
+        self,
+        repo: 'Repo',
+        info: RepoInfo,
+        branch_key: str,
+    ) -> Tuple['Repo', str, str]:
+        """
+        Create new branch from base branch and check it out in a new worktree.
+
+        Using worktrees lets multiple base branches of the same clone be used at the same time.
+        The new branch name only depends on the base branch and the given key, so that
+        processing the same patch again, or a revised version of it, uses the same branch.
+
+        :param repo: the repo object
+        :param info: the information of the target
+        :param branch_key: the unique key for the new branch
+        :return: (the worktree repo object,
+            the name of the new branch on which to apply the patch,
             the name of the original/base branch)
         """
-        base_branch_name = str(repo.active_branch)
-        new_branch_name = f'{base_branch_name}-{time.strftime("%Y%m%d%H%M%S")}'
-        print(f"creating new branch '{new_branch_name}' from branch '{base_branch_name}'")
-        new_branch = repo.create_head(new_branch_name)
-        print('switching to new branch')
-        repo.head.reference = new_branch
-        return new_branch_name, base_branch_name
+        from git import GitError
+        from git import Repo
+        base_branch_name = info.branch if info.branch is not None \
+            else self.get_default_branch(repo)
+        new_branch_name = f'{base_branch_name}-{branch_key}'
+        worktree_path = os.path.join(
+            self.repo_dir, 'worktrees', info.owner, info.name, new_branch_name)
+        logger.info(f"creating new branch '{new_branch_name}' from branch '{base_branch_name}'")
+        try:
+            with self._worktree_lock(repo):
+                # Remove leftovers from a previous attempt, if any
+                if os.path.exists(worktree_path):
+                    shutil.rmtree(worktree_path, ignore_errors=True)
+                    repo.git.worktree('prune')
+                # Branch might also exist from a previous attempt, so reset it
+                repo.git.worktree(
+                    'add', '--no-track', '-B', new_branch_name, worktree_path,
+                    f'origin/{base_branch_name}')
+        except GitError as e:
+            raise utils.EmailToPrError('failed to create branch', e)
+        return Repo(worktree_path), new_branch_name, base_branch_name
 
     def _apply_patch_file(
         self,
-        repo: Repo,
+        repo: 'Repo',
         patch_filename: str,
     ) -> None:
         """
@@ -140,51 +226,145 @@ class RepoManager():
         :param repo: the repo
         :param patch_filename: the name of the patch file to apply
         """
-        command = f'git am {patch_filename}'
+        command = f'git am {shlex.quote(patch_filename)}'
         args = shlex.split(command)
         repo_directory = repo.working_dir
-        print(f'previous commit: {repo.head.commit}')
-        print(f"applying patch '{patch_filename}'")
+        logger.debug(f'previous commit: {repo.head.commit}')
+        logger.info(f"applying patch '{patch_filename}'")
         try:
-            subprocess.check_output(args, cwd=repo_directory)
-            print(f'new commit: {repo.head.commit}')
+            subprocess.check_output(args, cwd=repo_directory, stderr=subprocess.STDOUT)
+            logger.debug(f'new commit: {repo.head.commit}')
         except subprocess.CalledProcessError as e:
-            raise utils.EmailToPrError('failed to apply patch file', e)
+            subprocess.call(
+                ['git', 'am', '--abort'],
+                cwd=repo_directory,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+            output = e.output.decode('utf-8', errors='replace').strip()
+            raise utils.EmailToPrError(f'failed to apply patch file: {output}', e)
 
     def apply_patch(
         self,
-        repo: Repo,
-        patch_filename: str,
-    ) -> str:
+        repo: 'Repo',
+        info: RepoInfo,
+        patch_path: str,
+        branch_key: str,
+    ) -> Tuple['Repo', str, str]:
         """
-        Apply patch to repo.
+        Apply patch to new branch created from the target base branch.
 
         :param repo: the repo object
-        :param patch_filename: the name of the patch file (should be in the repo directory)
-        :return: (the name of the branch on which the patch was applied,
+        :param info: the information of the target
+        :param patch_path: the path of the patch file
+        :param branch_key: the unique key for the new branch, e.g. from patch.get_branch_key()
+        :return: (the worktree repo object in which the patch was applied,
+            the name of the branch on which the patch was applied,
             the name of the original/base branch)
         """
-        # Create new branch from the current one
-        new_branch_name, base_branch_name = self._checkout_new_branch(repo)
-        # Apply patch file
-        self._apply_patch_file(repo, patch_filename)
-        return new_branch_name, base_branch_name
+        # Create new branch from the base branch
+        worktree, new_branch_name, base_branch_name = self._add_worktree(repo, info, branch_key)
+        try:
+            # Apply patch file
+            self._apply_patch_file(worktree, os.path.abspath(patch_path))
+        except utils.EmailToPrError:
+            self.remove_worktree(repo, worktree)
+            raise
+        return worktree, new_branch_name, base_branch_name
+
+    def remove_worktree(
+        self,
+        repo: 'Repo',
+        worktree: 'Repo',
+    ) -> None:
+        """
+        Remove worktree, keeping its branch.
+
+        :param repo: the main repo object
+        :param worktree: the worktree repo object
+        """
+        from git import GitError
+        try:
+            with self._worktree_lock(repo):
+                repo.git.worktree('remove', '--force', worktree.working_dir)
+        except GitError as e:
+            logger.warning(f'failed to remove worktree: {e}')
+
+    def _get_patch_id(
+        self,
+        repo: 'Repo',
+        diff_range: str,
+    ) -> Union[str, None]:
+        """
+        Get stable patch ID of the diff of a range of commits.
+
+        The patch ID does not depend on the commits' base, dates, or messages.
+
+        :param repo: the repo object
+        :param diff_range: the range of commits to diff, e.g. 'base...branch'
+        :return: the patch ID, or `None` if the diff is empty
+        """
+        try:
+            diff = subprocess.run(
+                ['git', 'diff', diff_range],
+                cwd=repo.working_dir,
+                stdout=subprocess.PIPE,
+                check=True).stdout
+            output = subprocess.run(
+                ['git', 'patch-id', '--stable'],
+                cwd=repo.working_dir,
+                input=diff,
+                stdout=subprocess.PIPE,
+                check=True).stdout
+        except subprocess.CalledProcessError as e:
+            raise utils.EmailToPrError('failed to compute patch ID', e)
+        parts = output.split()
+        return parts[0].decode('ascii') if parts else None
+
+    def _remote_branch_exists(
+        self,
+        repo: 'Repo',
+        branch: str,
+    ) -> bool:
+        """
+        Check if a branch exists on the remote, as of the last fetch.
+
+        :param repo: the repo object
+        :param branch: the branch name
+        """
+        return any(ref.remote_head == branch for ref in repo.remotes.origin.refs)
 
     def push(
         self,
-        repo: Repo,
-    ) -> None:
+        repo: 'Repo',
+        base_branch: str,
+    ) -> bool:
         """
-        Push current branch to remote.
+        Push current branch to remote, unless it already has the same changes.
+
+        If the remote branch exists but has different changes, it is force-updated.
 
         :param repo: the repo object
+        :param base_branch: the name of the base branch
+        :return: `True` if the branch was pushed, `False` if it was already up to date
         """
-        print('pushing branch to remote')
+        from git import GitError
+        branch = str(repo.active_branch)
+        force = False
+        if self._remote_branch_exists(repo, branch):
+            local_id = self._get_patch_id(repo, f'origin/{base_branch}...{branch}')
+            remote_id = self._get_patch_id(repo, f'origin/{base_branch}...origin/{branch}')
+            if local_id == remote_id:
+                logger.info(f"remote branch '{branch}' is already up to date")
+                return False
+            force = True
+        logger.info(f"{'force-' if force else ''}pushing branch to remote")
         try:
             # Use local branch name as upstream branch name
-            info_list = repo.remotes.origin.push(refspec=repo.active_branch)
+            refspec = f'{branch}:{branch}'
+            repo.remotes.origin.push(refspec=f'+{refspec}' if force else refspec)
         except GitError as e:
             raise utils.EmailToPrError('failed to push branch to remote', e)
+        return True
 
 
 def add_args(parser: argparse.ArgumentParser) -> None:
@@ -199,6 +379,12 @@ def add_args(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         'repo_token',
         help='the token for remote repo authentication')
+    parser.add_argument(
+        '--target-workers',
+        help='the maximum number of targets of an email processed at the same time '
+        '(default: %(default)s)',
+        type=int,
+        default=4)
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -209,6 +395,7 @@ def get_parser() -> argparse.ArgumentParser:
     add_args(parser)
     return parser
 
+
 def parse_args() -> Any:
     """Parse email polling arguments."""
     return get_parser().parse_args()
@@ -217,10 +404,11 @@ def parse_args() -> Any:
 def main() -> None:
     """Entrypoint for testing."""
     args = parse_args()
+    log.setup(secrets=[args.repo_token])
     manager = RepoManager(args)
     info = RepoInfo(args.repo_dir, 'https://github.com/christophebedard/email2pr.git', 'master')
-    repo = manager._clone(info)
-    manager.apply_patch(repo, info, 'todo')
+    repo = manager.fetch(info)
+    manager.apply_patch(repo, info, 'todo', 'test')
 
 
 if __name__ == '__main__':
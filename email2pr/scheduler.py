@@ -0,0 +1,338 @@
+"""Module for fair scheduling of email processing jobs."""
+
+import argparse
+import logging
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket():
+    """Token bucket rate limiter."""
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+    ) -> None:
+        """
+        Constructor.
+
+        :param rate: the number of tokens added per second
+        :param capacity: the maximum number of tokens (i.e. the burst size)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_consume(self, now: float) -> bool:
+        """
+        Consume a token if one is available.
+
+        :param now: the current monotonic time
+        :return: `True` if a token was consumed, `False` otherwise
+        """
+        self._refill(now)
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+    def delay(self, now: float) -> float:
+        """
+        Get the time until the next token is available.
+
+        :param now: the current monotonic time
+        :return: the delay in seconds
+        """
+        self._refill(now)
+        if self._tokens >= 1.0:
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+
+class Job():
+    """Unit of work to schedule."""
+
+    def __init__(
+        self,
+        sender: str,
+        repo: str,
+        func: Callable[[], None],
+        resources: Iterable[str] = None,
+    ) -> None:
+        """
+        Constructor.
+
+        :param sender: the sender of the email, used for fairness and rate limiting
+        :param repo: the target repo of the email, used for fairness
+        :param func: the function to call to process the job
+        :param resources: the resources that can only be used by one job at a time,
+            or `None` to use the target repo
+        """
+        self.sender = sender
+        self.repo = repo
+        self.func = func
+        self.resources = frozenset(resources if resources is not None else [repo])
+        self.enqueued_at = None
+        self.finish_tag = 0.0
+
+    @property
+    def job_class(self) -> Tuple[str, str]:
+        return self.sender, self.repo
+
+
+class WaitStats():
+    """Queue wait time statistics for a job class."""
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def add(self, wait_s: float) -> None:
+        self.count += 1
+        self.total_s += wait_s
+        self.max_s = max(self.max_s, wait_s)
+
+    @property
+    def mean_s(self) -> float:
+        return self.total_s / self.count if self.count > 0 else 0.0
+
+
+class FairScheduler():
+    """
+    Weighted fair queuing scheduler.
+
+    Jobs are grouped into classes by (sender, repo). Each class gets a share of the workers
+    proportional to its weight, each sender is rate-limited by a token bucket, and the total
+    number of jobs running at once is capped. Jobs sharing a resource (e.g. a repo directory)
+    never run at the same time.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 1,
+        sender_rate: float = 0.0,
+        sender_burst: float = 1.0,
+        weights: Dict[str, float] = None,
+    ) -> None:
+        """
+        Constructor.
+
+        :param max_concurrency: the maximum number of jobs running at the same time
+        :param sender_rate: the number of jobs per second allowed for each sender,
+            or 0 for no limit
+        :param sender_burst: the number of jobs a sender can start in a burst
+        :param weights: the weight of senders or repos, by name (default: 1)
+        """
+        self._max_concurrency = max(1, max_concurrency)
+        self._sender_rate = sender_rate
+        self._sender_burst = max(1.0, sender_burst)
+        self._weights = weights if weights is not None else {}
+        self._lock = threading.Condition()
+        self._queues: Dict[Tuple[str, str], List[Job]] = {}
+        self._last_finish: Dict[Tuple[str, str], float] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._stats: Dict[Tuple[str, str], WaitStats] = {}
+        self._busy: Set[str] = set()
+        self._virtual_time = 0.0
+        self._running = 0
+        self._stopping = False
+        self._workers = [
+            threading.Thread(target=self._work, name=f'email2pr-worker-{i}', daemon=True)
+            for i in range(self._max_concurrency)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _weight(self, job: Job) -> float:
+        """Get weight of a job's class."""
+        return self._weights.get(job.sender, 1.0) * self._weights.get(job.repo, 1.0)
+
+    def submit(self, job: Job) -> None:
+        """
+        Add job to the queue.
+
+        :param job: the job to schedule
+        """
+        with self._lock:
+            job.enqueued_at = time.monotonic()
+            job_class = job.job_class
+            # Virtual finish tag: a class that sends a burst gets increasing tags,
+            # so other classes' jobs get interleaved with it
+            start = max(self._virtual_time, self._last_finish.get(job_class, 0.0))
+            job.finish_tag = start + 1.0 / self._weight(job)
+            self._last_finish[job_class] = job.finish_tag
+            self._queues.setdefault(job_class, []).append(job)
+            self._lock.notify()
+
+    def _bucket(self, sender: str) -> Union[TokenBucket, None]:
+        if self._sender_rate <= 0.0:
+            return None
+        if sender not in self._buckets:
+            self._buckets[sender] = TokenBucket(self._sender_rate, self._sender_burst)
+        return self._buckets[sender]
+
+    def _pop_next(self, now: float) -> Tuple[Union[Job, None], Union[float, None]]:
+        """
+        Pop next eligible job, with the lock held.
+
+        :param now: the current monotonic time
+        :return: (the job, or `None` if there is none,
+            the time to wait before a rate-limited job becomes eligible, or `None`)
+        """
+        best = None
+        wait = None
+        for queue in self._queues.values():
+            job = queue[0]
+            if job.resources & self._busy:
+                continue
+            bucket = self._bucket(job.sender)
+            if bucket is not None:
+                delay = bucket.delay(now)
+                if delay > 0.0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+            if best is None or job.finish_tag < best.finish_tag:
+                best = job
+        if best is None:
+            return None, wait
+        bucket = self._bucket(best.sender)
+        if bucket is not None:
+            bucket.try_consume(now)
+        queue = self._queues[best.job_class]
+        queue.pop(0)
+        if not queue:
+            del self._queues[best.job_class]
+        self._virtual_time = max(self._virtual_time, best.finish_tag - 1.0 / self._weight(best))
+        return best, None
+
+    def _work(self) -> None:
+        """Worker loop."""
+        while True:
+            with self._lock:
+                job = None
+                while job is None:
+                    if self._stopping and not self._queues:
+                        return
+                    job, wait = self._pop_next(time.monotonic())
+                    if job is None:
+                        self._lock.wait(wait)
+                wait_s = time.monotonic() - job.enqueued_at
+                self._stats.setdefault(job.job_class, WaitStats()).add(wait_s)
+                self._busy |= job.resources
+                self._running += 1
+            try:
+                logger.info(
+                    f"starting job for '{job.sender}' on '{job.repo}'",
+                    extra={'queue_wait_ms': round(wait_s * 1000.0, 3)},
+                )
+                job.func()
+            except Exception as e:
+                # Don't let one job take down the worker
+                logger.exception(f"job for '{job.sender}' on '{job.repo}' failed: {e}")
+            finally:
+                with self._lock:
+                    self._busy -= job.resources
+                    self._running -= 1
+                    self._lock.notify_all()
+
+    def pending(self) -> int:
+        """Get number of jobs that are queued or running."""
+        with self._lock:
+            return sum(len(q) for q in self._queues.values()) + self._running
+
+    def wait_stats(self) -> Dict[Tuple[str, str], WaitStats]:
+        """Get queue wait time statistics, by (sender, repo) class."""
+        with self._lock:
+            return dict(self._stats)
+
+    def report(self) -> None:
+        """Log queue wait time statistics for each class."""
+        for (sender, repo), stats in sorted(self.wait_stats().items()):
+            logger.info(
+                f"queue wait for '{sender}' on '{repo}'",
+                extra={
+                    'sender': sender,
+                    'repo': repo,
+                    'count': stats.count,
+                    'mean_wait_ms': round(stats.mean_s * 1000.0, 3),
+                    'max_wait_ms': round(stats.max_s * 1000.0, 3),
+                },
+            )
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop workers once all queued jobs are done.
+
+        :param wait: whether to wait for the workers to finish
+        """
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+def add_args(parser: argparse.ArgumentParser) -> None:
+    """Add scheduling args."""
+    parser.add_argument(
+        '--max-concurrency', '-j',
+        help='the maximum number of emails processed at the same time (default: %(default)s)',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--sender-rate',
+        help='the number of emails per second processed for each sender, or 0 for no limit '
+        '(default: %(default)s)',
+        type=float,
+        default=0.0)
+    parser.add_argument(
+        '--sender-burst',
+        help='the number of emails from one sender that can be processed in a burst '
+        '(default: %(default)s)',
+        type=float,
+        default=5.0)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get parser."""
+    parser = argparse.ArgumentParser(
+        description='Schedule email processing.',
+        add_help=False)
+    add_args(parser)
+    return parser
+
+
+def from_params(params: Any) -> FairScheduler:
+    """
+    Create scheduler from parameters.
+
+    :param params: the parameters container
+    :return: the scheduler
+    """
+    return FairScheduler(
+        max_concurrency=int(utils.get_param(params, 'max_concurrency', 1)),
+        sender_rate=float(utils.get_param(params, 'sender_rate', 0.0)),
+        sender_burst=float(utils.get_param(params, 'sender_burst', 5.0)),
+        weights=utils.get_param(params, 'sched_weights'),
+    )
@@ -8,6 +8,9 @@ from typing import Union
 
 KEY_REPO_URL = 'Repo-Url'
 KEY_BASE_BRANCH = 'Base-Branch'
+KEY_LABELS = 'Labels'
+KEY_REVIEWERS = 'Reviewers'
+KEY_PROFILE = 'Profile'
 
 
 class EmailToPrError(Exception):
@@ -24,6 +27,19 @@ class EmailToPrError(Exception):
         super().__init__(msg)
 
 
+def get_param(params: Any, name: str, default: Any = None) -> Any:
+    """
+    Get value of an optional parameter.
+
+    :param params: the parameters container, i.e. parsed args or params.Params
+    :param name: the name of the parameter
+    :param default: the value to use if the parameter is not defined
+    :return: the value
+    """
+    value = getattr(params, name, None)
+    return value if value is not None else default
+
+
 def email_from_raw_data(raw_email_data: List[Any]) -> EmailMessage:
     """Get email message from raw data."""
     email_string = raw_email_data[0][1].decode('utf-8')
@@ -47,6 +63,24 @@ def get_key_value(body: str, key: str) -> Union[str, None]:
     return url
 
 
+def get_key_values(body: str, key: str) -> List[str]:
+    """
+    Extract all values for a given key, in order.
+
+    :param body: the body in which to search
+    :param key: the key to look for
+    :return: the values, without duplicates
+    """
+    values = []
+    for line in body.splitlines():
+        if line.startswith(key):
+            sep_index = line.find(':')
+            value = line[(sep_index + 1):].strip()
+            if value and value not in values:
+                values.append(value)
+    return values
+
+
 def get_repo_url(body: str) -> Union[str, None]:
     """
     Extract repo URL value from body.
@@ -57,6 +91,16 @@ def get_repo_url(body: str) -> Union[str, None]:
     return get_key_value(body, KEY_REPO_URL)
 
 
+def get_repo_urls(body: str) -> List[str]:
+    """
+    Extract all repo URL values from body.
+
+    :param body: the body in which to search
+    :return: the URL values
+    """
+    return get_key_values(body, KEY_REPO_URL)
+
+
 def get_base_branch(body: str) -> Union[str, None]:
     """
     Extract base branch value from body.
@@ -67,6 +111,61 @@ def get_base_branch(body: str) -> Union[str, None]:
     return get_key_value(body, KEY_BASE_BRANCH)
 
 
+def get_base_branches(body: str) -> List[str]:
+    """
+    Extract all base branch values from body.
+
+    :param body: the body in which to search
+    :return: the base branch values
+    """
+    return get_key_values(body, KEY_BASE_BRANCH)
+
+
+def get_key_list(body: str, key: str) -> List[str]:
+    """
+    Extract comma-separated list value for a given key.
+
+    :param body: the body in which to search
+    :param key: the key to look for
+    :return: the list of values, empty if not found
+    """
+    value = get_key_value(body, key)
+    if value is None:
+        return []
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def get_labels(body: str) -> List[str]:
+    """
+    Extract PR labels from body.
+
+    :param body: the body in which to search
+    :return: the label names
+    """
+    return get_key_list(body, KEY_LABELS)
+
+
+def get_reviewers(body: str) -> List[str]:
+    """
+    Extract PR reviewers from body.
+
+    :param body: the body in which to search
+    :return: the reviewer usernames
+    """
+    return get_key_list(body, KEY_REVIEWERS)
+
+
+def get_profile_requested(body: str) -> bool:
+    """
+    Check if profiling is requested in body.
+
+    :param body: the body in which to search
+    :return: `True` if the profile key is set to a true value
+    """
+    value = get_key_value(body, KEY_PROFILE)
+    return value is not None and value.lower() in ('1', 'true', 'yes', 'on')
+
+
 def insert_token_in_remote_url(
     url: str,
     user: str,
@@ -96,7 +195,7 @@ def strip_git_suffix(
     :param original: the original string, which might or might not already contain the suffix
     :return: the string without the suffix
     """
-    return original.strip('.git')
+    return original[:-len('.git')] if original.endswith('.git') else original
 
 
 def add_git_suffix(
@@ -0,0 +1,95 @@
+"""Tests for batched PR creation, using the fake GitHub GraphQL endpoint."""
+
+import unittest
+from unittest import mock
+
+from email2pr import github
+from email2pr.fake_github import FakeGitHub
+
+
+class TestCreatePrs(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.fake = FakeGitHub()
+        self.fake.add_repo('owner', 'repo', ['bug'])
+        self.fake.add_user('reviewer')
+
+    def _info(self, head: str, repo_name: str = 'repo', **kwargs) -> github.PrInfo:
+        return github.PrInfo('owner', repo_name, 'master', head, f'title {head}', '', **kwargs)
+
+    def test_results_mapped_to_prs(self) -> None:
+        infos = [
+            self._info('a', labels=['bug'], reviewers=['reviewer']),
+            self._info('b', repo_name='missing'),
+            self._info('c'),
+        ]
+        results = github.create_prs('token', infos, transport=self.fake, fallback=False)
+
+        self.assertEqual(3, len(results))
+        self.assertIsInstance(results[1], Exception)
+        prs = {pr['headRefName']: pr for pr in self.fake.pull_requests.values()}
+        self.assertEqual({'a', 'c'}, set(prs))
+        self.assertEqual(prs['a']['url'], results[0])
+        self.assertEqual(prs['c']['url'], results[2])
+        self.assertEqual(1, len(prs['a']['labelIds']))
+        self.assertEqual(1, len(prs['a']['reviewerIds']))
+        # Lookup, creation, and labels/reviews
+        self.assertEqual(3, self.fake.request_count)
+
+    def test_existing_pr_reused(self) -> None:
+        first = github.create_prs(
+            'token', [self._info('a')], transport=self.fake, fallback=False)
+        second = github.create_prs(
+            'token', [self._info('a')], transport=self.fake, fallback=False)
+
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(self.fake.pull_requests))
+
+    def test_missing_labels_and_reviewers_logged(self) -> None:
+        info = self._info('a', labels=['bug', 'unknown'], reviewers=['reviewer', 'nobody'])
+        with self.assertLogs(github.logger, 'WARNING') as logs:
+            results = github.create_prs('token', [info], transport=self.fake, fallback=False)
+
+        self.assertNotIsInstance(results[0], Exception)
+        output = '\n'.join(logs.output)
+        self.assertIn('unknown', output)
+        self.assertIn('nobody', output)
+
+    def test_rest_fallback_for_failed_prs(self) -> None:
+        infos = [self._info('a'), self._info('b', repo_name='missing')]
+        with mock.patch.object(github, 'create_pr', return_value='rest-url') as create_pr:
+            results = github.create_prs('token', infos, transport=self.fake)
+
+        create_pr.assert_called_once_with('token', infos[1])
+        self.assertEqual('rest-url', results[1])
+        self.assertNotEqual('rest-url', results[0])
+
+    def test_rest_fallback_when_batch_fails(self) -> None:
+        def failing_transport(query, variables):
+            return {'errors': [{'message': 'API rate limit exceeded'}]}
+
+        infos = [self._info('a'), self._info('b')]
+        with mock.patch.object(github, 'create_pr', return_value='rest-url') as create_pr:
+            results = github.create_prs('token', infos, transport=failing_transport)
+
+        self.assertEqual(2, create_pr.call_count)
+        self.assertEqual(['rest-url', 'rest-url'], results)
+
+
+class TestPrBatcher(unittest.TestCase):
+
+    def test_lone_pr_sent_without_delay(self) -> None:
+        fake = FakeGitHub()
+        fake.add_repo('owner', 'repo')
+        # A delay this long would time out the test if the PR waited for it
+        batcher = github.PrBatcher('token', delay_s=60.0, transport=fake)
+        batcher.register()
+        future = batcher.submit(github.PrInfo('owner', 'repo', 'master', 'a', 'title', ''))
+        url = future.result(timeout=5.0)
+        batcher.unregister()
+
+        self.assertTrue(url.startswith('https://github.com/owner/repo/pull/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Tests for resuming from the email checkpoint."""
+
+import os
+import tempfile
+import unittest
+
+from email2pr import poller
+
+
+class _Params():
+    email_user = 'user'
+    email_pass = 'pass'
+    email_host = None
+    email_port = None
+
+
+class _FakePoller(poller.EmailPoller):
+    """Email poller with an in-memory mailbox of patch emails."""
+
+    def __init__(self, uids, checkpoint, fail) -> None:
+        super().__init__(
+            poller.EmailConnectionInfo(_Params()), self._on_email, checkpoint=checkpoint)
+        self.uids = [str(uid).encode('ascii') for uid in uids]
+        self.fail = fail
+        self.handed_off = []
+
+    def _on_email(self, uid, raw_email_data) -> None:
+        self.handed_off.append(uid)
+        self.done(uid, uid not in self.fail)
+
+    def _get_email_uids(self, min_uid=None):
+        self._uidvalidity = 1
+        return [uid for uid in self.uids if min_uid is None or int(uid) >= min_uid]
+
+    def _get_emails_metadata(self, uids):
+        return {uid: poller.EmailMetadata(uid, 1, '[PATCH] change') for uid in uids}
+
+    def _get_email_from_uid(self, uid):
+        return [(b'1 (RFC822 {0}', b''), b' UID ' + uid + b')']
+
+
+class TestPollOnce(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoint = poller.Checkpoint(os.path.join(self.directory.name, 'state.json'))
+        _FakePoller([3], self.checkpoint, set()).poll_once()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def _run(self, fail=()):
+        email_poller = _FakePoller([3, 10, 11, 12], self.checkpoint, set(fail))
+        email_poller.poll_once()
+        return email_poller.handed_off
+
+    def test_only_failed_emails_processed_again(self) -> None:
+        self.assertEqual([10, 11, 12], self._run(fail=[10]))
+        self.assertEqual((9, 1, {10: 1}, {11, 12}), self.checkpoint.load())
+
+        self.assertEqual([10], self._run())
+        self.assertEqual((12, 1, {}, set()), self.checkpoint.load())
+        self.assertEqual([], self._run())
+
+    def test_failed_email_given_up(self) -> None:
+        for _ in range(poller.DEFAULT_MAX_ATTEMPTS):
+            self._run(fail=[11])
+
+        self.assertEqual((12, 1, {}, set()), self.checkpoint.load())
+        self.assertEqual([], self._run(fail=[11]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""Tests for job profiling."""
+
+import glob
+import os
+import tempfile
+import threading
+import tracemalloc
+import unittest
+
+from email2pr import profiling
+
+
+class TestJobProfiler(unittest.TestCase):
+
+    def test_concurrent_jobs(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = profiling.JobProfiler(directory, profile_all=True)
+            both_started = threading.Barrier(2, timeout=5.0)
+            errors = []
+
+            def job(uid: str) -> None:
+                try:
+                    with profiler.profile(uid, 'repo'):
+                        both_started.wait()
+                        sum(i * i for i in range(1000))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=job, args=(str(i),)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual([], errors)
+            self.assertFalse(tracemalloc.is_tracing())
+            self.assertEqual(2, len(glob.glob(os.path.join(directory, '*.tracemalloc'))))
+            # Python >= 3.12 only allows one cProfile profiler at a time
+            self.assertGreaterEqual(len(glob.glob(os.path.join(directory, '*.prof'))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()